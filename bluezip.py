@@ -5,10 +5,8 @@ import tempfile
 import argparse
 import datetime
 import sqlite3
-import hashlib
 import getpass
-import zipfile
-import fnmatch
+import heapq
 import shutil
 import socket
 import json
@@ -21,15 +19,25 @@ import os
 import yaml
 import bluezip_dat
 import bluezip_hook
+import torrentzip
 from util import TermColor, pcolor
 import util
 
 DATABASE_VERSION = '1'
 DIST_DIR = os.path.abspath('dist')
+BATCH_COMMIT_INTERVAL = 32
 
 class Settings:
     def __init__(self, db):
         self.db = db
+        self.cache = None
+
+    def _load(self):
+        if self.cache is None:
+            c = self.db.cursor()
+            c.execute('SELECT key, value FROM setting')
+            self.cache = dict(c)
+        return self.cache
 
     def get(self, key, default=None):
         try:
@@ -50,22 +58,18 @@ class Settings:
         return value
 
     def __getitem__(self, key):
-        c = self.db.cursor()
-        c.execute('SELECT value FROM setting WHERE key = ?', (key,))
-        value = c.fetchone()
-        if not value:
-            raise IndexError()
-        return value[0]
+        try:
+            return self._load()[key]
+        except KeyError:
+            raise IndexError() from None
 
     def __setitem__(self, key, value):
         self.db.execute('REPLACE INTO setting (key, value) VALUES (?,?)', (key, value))
         self.db.commit()
+        self._load()[key] = value
 
     def __iter__(self):
-        c = self.db.cursor()
-        c.execute('SELECT key, value FROM setting')
-        for key, value in c:
-            yield key, value
+        yield from self._load().items()
 
 @dataclass
 class Game:
@@ -96,7 +100,6 @@ def game_from_fp_database(uid, content_path):
     c = fp_db.cursor()
     c.execute('SELECT title, platform FROM game WHERE id = ?', (uid,))
     game = c.fetchone()
-    fp_db.close()
     if not game:
         raise ValueError(f'No game found by UUID: {uid}')
 
@@ -109,28 +112,28 @@ def create_torrentzip(uid, platform, build_dir, dist_file):
         'uniqueId': uid,
         'platform': platform
     }
-    with open(os.path.join(build_dir, 'content.json'), 'w', encoding='utf-8', newline='\r\n') as f:
-        json.dump(content_meta, f, indent=4)
-    with zipfile.ZipFile(dist_file, 'w', strict_timestamps=False) as z:
-        for r, _, f in os.walk(build_dir):
-            for fname in f:
-                path = os.path.join(r, fname)
-                rel = os.path.relpath(path, build_dir).replace(os.path.sep, '/')
-                z.write(path, arcname=rel)
-    subprocess.check_call(['bin/trrntzip', dist_file], stdout=subprocess.DEVNULL)
-    return util.digest(dist_file, hashlib.sha256())
+    files = {os.path.relpath(entry.path, build_dir).replace(os.path.sep, '/'): entry.path for entry in util.scan(build_dir)}
+    files['content.json'] = json.dumps(content_meta, indent=4).replace('\n', '\r\n').encode('utf-8')
+    return torrentzip.write(dist_file, files)
 
 def delete_paths(root, paths):
     for path in paths:
         os.remove(path)
-    for path in paths:
-        while True:
-            try:
-                path = os.path.abspath(os.path.join(path, os.pardir))
-                os.rmdir(path)
-                print('Removed empty folder:', os.path.relpath(path, root))
-            except OSError:
-                break
+    # Deepest folders first, so each folder is only tried once all of its subfolders have been
+    folders = {os.path.dirname(os.path.abspath(path)) for path in paths}
+    queue = [(-folder.count(os.sep), folder) for folder in folders]
+    heapq.heapify(queue)
+    while queue:
+        _, folder = heapq.heappop(queue)
+        try:
+            os.rmdir(folder)
+        except OSError:
+            continue
+        print('Removed empty folder:', os.path.relpath(folder, root))
+        parent = os.path.dirname(folder)
+        if parent != folder and parent not in folders:
+            folders.add(parent)
+            heapq.heappush(queue, (-parent.count(os.sep), parent))
 
 def rollback(db, session):
     c = db.cursor()
@@ -144,7 +147,7 @@ def rollback(db, session):
     print(f'Rolling back database to {date}')
     if not util.prompt('Proceed?'):
         sys.exit(0)
-    db.execute('DELETE FROM file WHERE game_sha IN (SELECT sha256 FROM game WHERE session = ?)', (prev_session,))
+    db.execute('WITH victims (sha) AS (SELECT sha256 FROM game WHERE session = ?) DELETE FROM file WHERE game_sha IN victims', (prev_session,))
     db.execute('DELETE FROM game WHERE session = ?', (prev_session,))
     db.execute('UPDATE session SET rollback = ? WHERE id = ?', (session, prev_session))
     db.commit()
@@ -160,21 +163,23 @@ class Bluezip:
         self.settings = settings
         self.session = session
         self.args = args
+        self.batch = False
+        self.archive_pattern = util.extension_pattern(settings['archive_extensions'].split(','))
+        self.exclude_pattern = util.fnmatch_pattern(settings['obsolete_exclude'].split(','))
 
     def cleanup_obsolete(self, game, sha):
-        htdocs = self.args.htdocs
-        if not htdocs:
+        if not self.args.htdocs:
             return
+        htdocs = os.path.abspath(self.args.htdocs)
         c = self.db.cursor()
         c.execute('SELECT file FROM file WHERE game_sha = ?', (sha,))
-        exclude = self.settings['obsolete_exclude'].split(',')
         obsolete = list()
         for (fname,) in c:
             contentless = re.sub('^content/', '', fname)
             path = os.path.abspath(os.path.join(htdocs, contentless))
             rel = os.path.relpath(path, htdocs)
             if os.path.isfile(path):
-                if any([fnmatch.fnmatch(rel, rule) for rule in exclude]):
+                if self.exclude_pattern.match(os.path.normcase(rel)):
                     print('Obsolete (excluded):', rel)
                     continue
                 obsolete.append(path)
@@ -196,23 +201,21 @@ class Bluezip:
         revision, prev_sha256, prev_title = c.fetchone() or (1, None, None)
         os.mkdir(build_dir)
         shutil.move(game.content_path, os.path.join(build_dir, 'content'))
-        sha256 = create_torrentzip(game.uid, game.platform, build_dir, dist)
+        try:
+            sha256, digests = create_torrentzip(game.uid, game.platform, build_dir, dist)
+        except BaseException:
+            shutil.move(os.path.join(build_dir, 'content'), game.content_path)
+            shutil.rmtree(tmp, onerror=remove_readonly)
+            raise
         outfile = os.path.join(DIST_DIR, f'{game.uid}.zip')
         shutil.move(dist, outfile)
         if prev_sha256:
             if prev_sha256 == sha256:
                 pcolor('green', 'no change')
+                shutil.rmtree(tmp, onerror=remove_readonly)
                 return
             revision += 1
-        for r, _, f in os.walk(build_dir):
-            for fname in f:
-                path = os.path.join(r, fname)
-                rel = os.path.relpath(path, build_dir).replace(os.path.sep, '/')
-                crc = util.crc32(path)
-                md5 = util.digest(path, hashlib.md5())
-                sha = util.digest(path, hashlib.sha1())
-                size = os.stat(path).st_size
-                self.db.execute('INSERT INTO file VALUES (?,?,?,?,?,?)', (sha256, rel, size, crc, md5, sha))
+        rows = [(sha256, rel, *digest) for rel, digest in digests.items()]
         short_sha = sha256.hex()[:6].upper()
         pcolor('green', f'[rev {revision}: {short_sha}]')
         if prev_title and prev_title != game.title:
@@ -222,7 +225,9 @@ class Bluezip:
         except sqlite3.IntegrityError as e:
             pcolor('red', f'Error: {e} when storing {game.title}. Skipped.')
             return
-        self.db.commit()
+        self.db.executemany('INSERT INTO file VALUES (?,?,?,?,?,?)', rows)
+        if not self.batch:
+            self.db.commit()
         shutil.rmtree(tmp, onerror=remove_readonly)
         if revision == 1:
             self.cleanup_obsolete(game, sha256)
@@ -260,8 +265,7 @@ class Bluezip:
     def process_auto(self, path, from_db=False):
         kind = 'Content' if from_db else 'Curation'
         fname = os.path.basename(path)
-        exts = self.settings['archive_extensions'].split(',')
-        ext = util.extension(fname, exts)
+        ext = util.extension(fname, self.archive_pattern)
         if os.path.isfile(path) and ext:
             print(f'{kind} archive ({ext}): {fname}'.ljust(80), end='', flush=True)
             self.process_archive(path, from_db)
@@ -274,11 +278,19 @@ class Bluezip:
         self.process_game_from_path(fname, path, from_db)
 
     def process_all(self, path):
-        for name in os.listdir(path):
-            try:
-                self.process_auto(os.path.join(path, name))
-            except ValueError as e:
-                pcolor('red', f'Error: {e} in {name}. Skipped.')
+        self.batch = True
+        try:
+            for i, name in enumerate(os.listdir(path), 1):
+                try:
+                    self.process_auto(os.path.join(path, name))
+                except (ValueError, torrentzip.TooLargeError) as e:
+                    pcolor('red', f'Error: {e} in {name}. Skipped.')
+                if i % BATCH_COMMIT_INTERVAL == 0:
+                    self.db.commit()
+        finally:
+            # Games already moved to DIST_DIR must stay recorded, even on abort
+            self.db.commit()
+            self.batch = False
 
 def main():
     global DIST_DIR
@@ -301,10 +313,17 @@ def main():
         os.system('color')
 
     db = sqlite3.connect('bluezip.db')
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.execute('PRAGMA temp_store = MEMORY')
+    db.execute('PRAGMA mmap_size = 268435456')
+    db.execute('PRAGMA cache_size = -65536')
     db.execute('CREATE TABLE IF NOT EXISTS setting (key TEXT PRIMARY KEY, value TEXT)')
     db.execute('CREATE TABLE IF NOT EXISTS session (id TEXT PRIMARY KEY, user TEXT, operation TEXT, time INTEGER, rollback TEXT)')
     db.execute('CREATE TABLE IF NOT EXISTS file (game_sha BLOB, file TEXT, size INTEGER, crc INTEGER, md5 BLOB, sha1 BLOB)')
     db.execute('CREATE TABLE IF NOT EXISTS game (id TEXT, revision INTEGER, sha256 BLOB UNIQUE, title TEXT, platform TEXT, session TEXT, PRIMARY KEY (id, revision))')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_file_game_sha ON file (game_sha)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_game_session ON game (session)')
     session = os.urandom(6).hex()
     user = '%s@%s' % (getpass.getuser(), socket.gethostname())
     settings = Settings(db)
@@ -340,7 +359,7 @@ def main():
             log_session('BUILD')
             try:
                 bluezip.process_auto(args.path, args.convert)
-            except ValueError as e:
+            except (ValueError, torrentzip.TooLargeError) as e:
                 pcolor('red', f'\nError: {e}')
                 sys.exit(1)
         sys.exit(0)
@@ -1,34 +1,53 @@
 import lxml.etree as ET
 from collections import namedtuple
+from functools import lru_cache
+from itertools import groupby, chain
+from operator import attrgetter
 
 DOCTYPE = '<!DOCTYPE datafile PUBLIC "-//Logiqx//DTD ROM Management Datafile//EN" "http://www.logiqx.com/Dats/datafile.dtd">'
 
+@lru_cache(maxsize=None)
+def row_class(fields):
+    return namedtuple("Row", fields)
+
 def namedtuple_factory(cursor, row):
     """Returns sqlite rows as named tuples."""
-    fields = [col[0] for col in cursor.description]
-    Row = namedtuple("Row", fields)
-    return Row(*row)
+    fields = tuple(col[0] for col in cursor.description)
+    return row_class(fields)(*row)
 
-def export_dat(db, filename):
-    db.row_factory = namedtuple_factory
-    root = ET.Element('datafile')
-    header = ET.SubElement(root, 'header')
+def dat_header():
+    header = ET.Element('header')
     ET.SubElement(header, 'name').text = 'BlueMaxima\'s Flashpoint'
     ET.SubElement(header, 'description').text = 'BlueMaxima\'s Flashpoint'
     ET.SubElement(header, 'author').text = 'Flashpoint contributors'
     ET.SubElement(header, 'homepage').text = 'BlueMaxima\'s Flashpoint'
     ET.SubElement(header, 'url').text = 'https://bluemaxima.org/flashpoint/'
-    c = db.cursor()
-    c.execute('SELECT * FROM game')
-    for game in c:
-        f = db.cursor()
-        f.execute("SELECT file, size, printf('%X', crc) AS crc, hex(md5) AS md5, hex(sha1) AS sha1 FROM file WHERE game_sha = ?", (game.sha256,))
-        elem = ET.SubElement(root, 'game', name=game.id)
-        ET.SubElement(elem, 'description').text = game.title
-        for entry in f:
-            ET.SubElement(elem, 'rom', name=f'{entry.file}', size=str(entry.size), crc=entry.crc, md5=entry.md5, sha1=entry.sha1, status='verified')
+    return header
 
-    tree = ET.ElementTree(root)
-    xml = ET.tostring(tree, pretty_print=True, xml_declaration=True, encoding="UTF-8", doctype=DOCTYPE)
+def write_indented(xf, elem):
+    """Writes elem as a pretty-printed child of the root element."""
+    ET.indent(elem, level=1)
+    xf.write('\n  ')
+    xf.write(elem)
+
+def export_dat(db, filename):
+    c = db.cursor()
+    c.row_factory = namedtuple_factory
+    c.execute("""SELECT game.id, game.title, game.sha256, file.file, file.size, printf('%X', file.crc) AS crc, hex(file.md5) AS md5, hex(file.sha1) AS sha1
+                 FROM game LEFT JOIN file ON file.game_sha = game.sha256 ORDER BY game.rowid, file.rowid""")
     with open(filename, 'wb') as f:
-        f.write(xml)
+        with ET.xmlfile(f, encoding='UTF-8') as xf:
+            xf.write_declaration()
+            xf.write_doctype(DOCTYPE)
+            with xf.element('datafile'):
+                write_indented(xf, dat_header())
+                for _, entries in groupby(c, key=attrgetter('sha256')):
+                    entry = next(entries)
+                    elem = ET.Element('game', name=entry.id)
+                    ET.SubElement(elem, 'description').text = entry.title
+                    if entry.file is not None:
+                        for entry in chain([entry], entries):
+                            ET.SubElement(elem, 'rom', name=f'{entry.file}', size=str(entry.size), crc=entry.crc, md5=entry.md5, sha1=entry.sha1, status='verified')
+                    write_indented(xf, elem)
+                xf.write('\n')
+        f.write(b'\n')
@@ -2,12 +2,21 @@ from unittest.mock import patch
 import unittest
 import tempfile
 import sqlite3
+import hashlib
+import fnmatch
+import zlib
+import zipfile
 import shutil
 import os
 
+import lxml.etree as ET
 import yaml
 
 import bluezip
+import torrentzip
+import bluezip_dat
+import bluezip_hook
+import util
 
 # chosen by fair dice roll
 RANDOM_UUID = 'c27c7809-d79b-4db0-94da-df8f89955aff'
@@ -85,6 +94,89 @@ class Test_game_from_fp_db(unittest.TestCase):
         expect = bluezip.Game(*args, '')
         self.assertEqual(expect, bluezip.game_from_fp_database(RANDOM_UUID, ''))
 
+class Test_delete_paths(TestTempFile):
+    @patch('builtins.print')
+    def test_ok(self, _):
+        self.write('htdocs/keep.txt')
+        self.write('htdocs/a/b/c/game.swf')
+        self.write('htdocs/a/d/e/f/data.xml')
+        self.write('htdocs/g/game.swf')
+        self.write('htdocs/g/keep.txt')
+        paths = [self.join(path) for path in ['htdocs/a/b/c/game.swf', 'htdocs/a/d/e/f/data.xml', 'htdocs/g/game.swf']]
+        bluezip.delete_paths(self.join('htdocs'), paths)
+        self.assertEqual(['g', 'keep.txt'], sorted(os.listdir(self.join('htdocs'))))
+        self.assertEqual(['keep.txt'], os.listdir(self.join('htdocs/g')))
+
+class Test_export_dat(TestTempFile):
+    def test_ok(self):
+        db = sqlite3.connect(':memory:')
+        db.execute('CREATE TABLE file (game_sha BLOB, file TEXT, size INTEGER, crc INTEGER, md5 BLOB, sha1 BLOB)')
+        db.execute('CREATE TABLE game (id TEXT, revision INTEGER, sha256 BLOB UNIQUE, title TEXT, platform TEXT, session TEXT, PRIMARY KEY (id, revision))')
+        db.execute('INSERT INTO game VALUES (?,?,?,?,?,?)', (RANDOM_UUID, 1, b'\x01', 'Alien Hominid', 'Flash', ''))
+        db.execute('INSERT INTO game VALUES (?,?,?,?,?,?)', (RANDOM_UUID, 2, b'\x02', 'Alien Hominid', 'Flash', ''))
+        db.execute('INSERT INTO file VALUES (?,?,?,?,?,?)', (b'\x02', 'content.json', 26, 0xBEEF, b'\xab', b'\xcd'))
+        dat = self.join('flashpoint.dat')
+        bluezip_dat.export_dat(db, dat)
+        with open(dat, 'rb') as f:
+            xml = f.read()
+        self.assertIn(b'\n  <game name="c27c7809-d79b-4db0-94da-df8f89955aff">\n    <description>', xml)
+        self.assertTrue(xml.endswith(b'  </game>\n</datafile>\n'))
+        root = ET.parse(dat).getroot()
+        games = root.findall('game')
+        self.assertEqual(2, len(games))
+        self.assertEqual([], games[0].findall('rom'))
+        rom, = games[1].findall('rom')
+        self.assertEqual('Alien Hominid', games[1].findtext('description'))
+        expect = { 'name': 'content.json', 'size': '26', 'crc': 'BEEF', 'md5': 'AB', 'sha1': 'CD', 'status': 'verified' }
+        self.assertEqual(expect, dict(rom.attrib))
+
+class Test_hooks_add(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.execute('CREATE TABLE game (id TEXT, revision INTEGER)')
+        self.fp_db = sqlite3.connect(':memory:')
+        self.fp_db.execute('CREATE TABLE game (id TEXT PRIMARY KEY)')
+        self.fp_db.execute('CREATE TABLE additional_app (id TEXT PRIMARY KEY, applicationPath TEXT, autoRunBefore INTEGER, launchCommand TEXT, name TEXT, waitForExit INTEGER, parentGameId TEXT)')
+
+    @patch('builtins.print')
+    def test_ok(self, _):
+        other = '00000000-0000-0000-0000-000000000000'
+        self.db.executemany('INSERT INTO game VALUES (?,?)', [(RANDOM_UUID, 1), (RANDOM_UUID, 2)])
+        self.fp_db.executemany('INSERT INTO game VALUES (?)', [(RANDOM_UUID,), (other,)])
+        bluezip_hook.hooks_add(self.db, self.fp_db)
+        c = self.fp_db.execute("SELECT launchCommand, parentGameId FROM additional_app WHERE name = 'Mount'")
+        self.assertEqual([(RANDOM_UUID, RANDOM_UUID)], c.fetchall())
+
+class Test_extension_pattern(unittest.TestCase):
+    def test_ok(self):
+        pattern = util.extension_pattern(['zip', '7z', 'tar.gz', '('])
+        self.assertEqual('7z', util.extension('game.7z', pattern))
+        self.assertEqual('tar.gz', util.extension('game.tar.gz', pattern))
+        self.assertEqual('(', util.extension('game.(', pattern))
+        self.assertIsNone(util.extension('game.targz', pattern))
+        self.assertIsNone(util.extension('game.rar', pattern))
+
+class Test_fnmatch_pattern(unittest.TestCase):
+    def test_empty(self):
+        pattern = util.fnmatch_pattern(''.split(','))
+        self.assertIsNone(pattern.match(os.path.normcase('www.example.com/game.swf')))
+
+    def test_fnmatch(self):
+        rules = '*.html,www.example.com/assets/*,game?.swf'.split(',')
+        pattern = util.fnmatch_pattern(rules)
+        for path in ['index.html', 'www.example.com/assets/data.xml', 'game1.swf', 'game10.swf', 'www.example.com/game.swf']:
+            expect = any(fnmatch.fnmatch(path, rule) for rule in rules)
+            self.assertEqual(expect, bool(pattern.match(os.path.normcase(path))), path)
+
+class Test_data_digest(unittest.TestCase):
+    def test_ok(self):
+        data = TestTempFile.DUMMY
+        size, crc, md5, sha1 = util.data_digest(data)
+        self.assertEqual(len(data), size)
+        self.assertEqual(zlib.crc32(data), crc)
+        self.assertEqual(hashlib.md5(data).digest(), md5)
+        self.assertEqual(hashlib.sha1(data).digest(), sha1)
+
 class Test_create_torrentzip(TestTempFile):
     def test_ok(self):
         expect = '815bf52d71d9db68fbd1218297a363859034e5e6ed8f1dd6cd1c3313900ff927'
@@ -94,8 +186,47 @@ class Test_create_torrentzip(TestTempFile):
         self.write('game.swf')
         self.write('assets/data.xml')
         self.mkdir('music')
-        digest = bluezip.create_torrentzip(RANDOM_UUID, 'Flash', build, dist)
+        digest, entries = bluezip.create_torrentzip(RANDOM_UUID, 'Flash', build, dist)
         self.assertEqual(expect, digest.hex())
+        expect_entries = ['content.json', 'content/www.example.com/assets/data.xml', 'content/www.example.com/game.swf']
+        self.assertEqual(expect_entries, list(entries))
+        self.assertEqual(util.data_digest(self.DUMMY), entries['content/www.example.com/game.swf'])
+
+class Test_torrentzip(TestTempFile):
+    def test_order(self):
+        names = ['content/ärger.swf', 'content/Über.swf', 'content/b.swf', 'content/A.swf', 'content/a.swf']
+        dist = self.join('game.zip')
+        torrentzip.write(dist, {name: self.DUMMY for name in names})
+        with zipfile.ZipFile(dist) as z:
+            order = [info.filename for info in z.infolist()]
+        self.assertEqual(['content/A.swf', 'content/a.swf', 'content/b.swf', 'content/Über.swf', 'content/ärger.swf'], order)
+
+    def test_long_name(self):
+        files = { 'content/' + 'a' * 0x10000: self.DUMMY }
+        self.assertRaises(torrentzip.TooLargeError, torrentzip.write, self.join('game.zip'), files)
+
+class Test_process_game(TestTempFile):
+    def setUp(self):
+        super().setUp()
+        db = sqlite3.connect(':memory:')
+        db.execute('CREATE TABLE game (id TEXT, revision INTEGER, sha256 BLOB UNIQUE, title TEXT, platform TEXT, session TEXT, PRIMARY KEY (id, revision))')
+        settings = { 'archive_extensions': 'zip,7z', 'obsolete_exclude': '' }
+        self.bluezip = bluezip.Bluezip(db, settings, '', None)
+
+    @patch('torrentzip.LIMIT', 8)
+    def test_too_large(self):
+        self.write('content/game.swf')
+        game = bluezip.Game(RANDOM_UUID, 'Alien Hominid', 'Flash', self.join('content'))
+        self.assertRaises(torrentzip.TooLargeError, self.bluezip.process_game, game)
+        self.assertEqual(['game.swf'], os.listdir(self.join('content')))
+
+    @patch('builtins.print')
+    @patch('torrentzip.LIMIT', 8)
+    def test_too_large_batch(self, _):
+        self.write(f'{RANDOM_UUID}/content/game.swf')
+        self.write(f'{RANDOM_UUID}/meta.yaml', b'Title: Alien Hominid\nPlatform: Flash\n')
+        self.bluezip.process_all(self.cwd)
+        self.assertEqual(['game.swf'], os.listdir(self.join(f'{RANDOM_UUID}/content')))
 
 if __name__ == '__main__':
     unittest.main()
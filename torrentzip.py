@@ -0,0 +1,135 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from collections import deque
+import hashlib
+import string
+import struct
+import zlib
+import os
+
+import util
+
+# Every entry is stamped with 1996-12-24 23:32:00
+DOS_TIME = 0xBC00
+DOS_DATE = 0x2198
+VERSION = 20
+FLAG_MAX_COMPRESSION = 0x0002
+FLAG_UTF8 = 0x0800
+LIMIT = 0xFFFFFFFF
+CHUNK_SIZE = 1 << 20
+# Entries up to this size are compressed in memory on worker threads, larger ones are streamed
+BUFFER_LIMIT = 4 << 20
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+COMPRESSED_SIZE_OFFSET = 18
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+class TooLargeError(Exception):
+    """Raised for archives that would need ZIP64, which TorrentZip does not support."""
+
+def sort_key(name):
+    # TrrntZip only folds A-Z when comparing names
+    return (name.translate(ASCII_LOWER), name)
+
+def encode_name(name):
+    try:
+        return name.encode('ascii'), FLAG_MAX_COMPRESSION
+    except UnicodeEncodeError:
+        return name.encode('utf-8'), FLAG_MAX_COMPRESSION | FLAG_UTF8
+
+def compressor():
+    return zlib.compressobj(9, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY)
+
+def deflate(f, data):
+    """Writes data to f as a raw deflate stream, one chunk at a time. Returns the compressed size."""
+    c = compressor()
+    compressed_size = 0
+    with memoryview(data) as view:
+        for i in range(0, len(view), CHUNK_SIZE):
+            chunk = c.compress(view[i:i + CHUNK_SIZE])
+            f.write(chunk)
+            compressed_size += len(chunk)
+    chunk = c.flush()
+    f.write(chunk)
+    return compressed_size + len(chunk)
+
+def read(source):
+    if isinstance(source, bytes):
+        return nullcontext(source)
+    return util.map_file(source)
+
+def prepare(source):
+    """Hashes source, and compresses it in memory unless it is larger than BUFFER_LIMIT."""
+    with read(source) as data:
+        digest = util.data_digest(data)
+        if len(data) > BUFFER_LIMIT:
+            return digest, None
+        c = compressor()
+        return digest, c.compress(data) + c.flush()
+
+def prepared(files, names):
+    """Yields (name, digest, compressed) for names in order, preparing a bounded number of entries ahead on worker threads."""
+    workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        window = deque()
+        try:
+            for name in names:
+                window.append((name, executor.submit(prepare, files[name])))
+                if len(window) > 2 * workers:
+                    name, future = window.popleft()
+                    yield (name, *future.result())
+            for name, future in window:
+                yield (name, *future.result())
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+def write(filename, files):
+    """Writes files, a dict of archive names to paths or bytes, as a TorrentZip to filename.
+
+    Returns the SHA-256 digest of the written archive and a dict of archive
+    names to the (size, crc, md5, sha1) of each entry."""
+    central = list()
+    digests = dict()
+    with open(filename, 'wb') as f:
+        for name, digest, compressed in prepared(files, sorted(files, key=sort_key)):
+            digests[name] = digest
+            size, crc, _, _ = digest
+            encoded, flags = encode_name(name)
+            if len(encoded) > 0xFFFF:
+                raise TooLargeError(f'{name} is too long for TorrentZip')
+            offset = f.tell()
+            if size > LIMIT or offset > LIMIT:
+                raise TooLargeError(f'{name} is too large for TorrentZip')
+            if compressed is None:
+                # Large entries are streamed, and their compressed size is patched in afterwards
+                f.write(LOCAL_HEADER.pack(0x04034b50, VERSION, flags, zlib.DEFLATED, DOS_TIME, DOS_DATE,
+                                          crc, 0, size, len(encoded), 0))
+                f.write(encoded)
+                with read(files[name]) as data:
+                    compressed_size = deflate(f, data)
+                if compressed_size > LIMIT:
+                    raise TooLargeError(f'{name} is too large for TorrentZip')
+                end = f.tell()
+                f.seek(offset + COMPRESSED_SIZE_OFFSET)
+                f.write(struct.pack('<I', compressed_size))
+                f.seek(end)
+            else:
+                compressed_size = len(compressed)
+                f.write(LOCAL_HEADER.pack(0x04034b50, VERSION, flags, zlib.DEFLATED, DOS_TIME, DOS_DATE,
+                                          crc, compressed_size, size, len(encoded), 0))
+                f.write(encoded)
+                f.write(compressed)
+            central.append(CENTRAL_HEADER.pack(0x02014b50, 0, VERSION, flags, zlib.DEFLATED, DOS_TIME, DOS_DATE,
+                                               crc, compressed_size, size, len(encoded), 0, 0, 0, 0, 0, offset)
+                           + encoded)
+        directory = b''.join(central)
+        directory_offset = f.tell()
+        if directory_offset > LIMIT or len(central) > 0xFFFF:
+            raise TooLargeError(f'{filename} is too large for TorrentZip')
+        comment = f'TORRENTZIPPED-{zlib.crc32(directory):08X}'.encode('ascii')
+        f.write(directory)
+        f.write(END_RECORD.pack(0x06054b50, 0, 0, len(central), len(central), len(directory), directory_offset, len(comment)))
+        f.write(comment)
+    return util.digest(filename, hashlib.sha256()), digests
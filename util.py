@@ -1,9 +1,26 @@
+from contextlib import contextmanager
+import hashlib
+import fnmatch
 import sqlite3
+import mmap
 import zlib
 import re
 import os
 
+# Files at least this large are hashed through mmap instead of a plain read
+MMAP_THRESHOLD = 1 << 20
+
+UUID_PATTERN = re.compile('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+_fp_db = None
+
 def open_db():
+    global _fp_db
+    if _fp_db is None:
+        _fp_db = connect_db()
+    return _fp_db
+
+def connect_db():
     try:
         with open('DB_PATH', 'r', encoding='utf-8') as f:
             path = f.read()
@@ -13,36 +30,66 @@ def open_db():
     if not os.path.isfile(path):
         print('\033[31mError: Flashpoint database in DB_PATH not found.\033[0m')
         return None
-    return sqlite3.connect(path)
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA cache_size = -64000')
+    return db
 
-def crc32(fname):
-    prev = 0
-    for line in open(fname, 'rb'):
-        prev = zlib.crc32(line, prev)
-    return prev & 0xFFFFFFFF
+@contextmanager
+def map_file(fname):
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            yield f.read()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            yield m
 
 def digest(fname, h):
-    with open(fname, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            h.update(chunk)
+    with map_file(fname) as data:
+        h.update(data)
     return h.digest()
 
+def data_digest(data):
+    md5 = hashlib.md5(data)
+    sha1 = hashlib.sha1(data)
+    return len(data), zlib.crc32(data) & 0xFFFFFFFF, md5.digest(), sha1.digest()
+
+def scan(path):
+    """Yields the file entries below path, in the same order as os.walk."""
+    files = list()
+    dirs = list()
+    with os.scandir(path) as it:
+        for entry in it:
+            if not entry.is_dir():
+                files.append(entry)
+            elif not entry.is_symlink():
+                dirs.append(entry.path)
+    yield from files
+    for d in dirs:
+        yield from scan(d)
+
 def find(path, fnames):
-    for r, _, f in os.walk(path):
-        for fname in f:
-            if fname.lower() in fnames:
-                return os.path.join(r, fname)
+    for entry in scan(path):
+        if entry.name.lower() in fnames:
+            return entry.path
     return None
 
 def validate_uuid(uid):
-    return re.match('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', uid)
+    return UUID_PATTERN.match(uid)
 
-def suffix(fname, suffixes):
+def suffix_pattern(suffixes):
     pattern = '|'.join(suffixes)
-    return re.match(f'.*({pattern})$', fname)
+    return re.compile(f'.*({pattern})$')
+
+def extension_pattern(extensions):
+    return suffix_pattern([re.escape('.' + ext) for ext in extensions])
+
+def fnmatch_pattern(rules):
+    """Compiles fnmatch rules into one regex, to be matched against os.path.normcase'd names."""
+    pattern = '|'.join(f'(?:{fnmatch.translate(os.path.normcase(rule))})' for rule in rules)
+    return re.compile(pattern)
 
-def extension(fname, extensions):
-    m = suffix(fname, [r'\.' + ext for ext in extensions])
+def extension(fname, pattern):
+    m = pattern.match(fname)
     if m:
         return m.group(1)[1:]
     return None